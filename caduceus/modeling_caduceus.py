@@ -157,6 +157,7 @@ class CaduceusMixerModel(nn.Module):
         self.fused_add_norm = config.fused_add_norm
         self.rcps = config.rcps
         self.residual_in_fp32 = config.residual_in_fp32
+        self.gradient_checkpointing = False  # Toggled by `CaduceusPreTrainedModel.gradient_checkpointing_enable()`
 
         self.embeddings = CaduceusEmbeddings(config, **factory_kwargs)
 
@@ -206,10 +207,14 @@ class CaduceusMixerModel(nn.Module):
         for layer in self.layers:
             if output_hidden_states:
                 all_hidden_states.append(hidden_states)
-            # TODO: Add support for gradient checkpointing
-            hidden_states, residual = layer(
-                hidden_states, residual, inference_params=None
-            )
+            if self.gradient_checkpointing and self.training:
+                hidden_states, residual = self._gradient_checkpointing_func(
+                    layer.__call__, hidden_states, residual, None
+                )
+            else:
+                hidden_states, residual = layer(
+                    hidden_states, residual, inference_params=None
+                )
 
         if not self.fused_add_norm:
             if self.rcps:
@@ -279,7 +284,7 @@ class CaduceusPreTrainedModel(PreTrainedModel):
     """PreTrainedModel wrapper for Caduceus backbone."""
     config_class = CaduceusConfig
     base_model_prefix = "caduceus"
-    supports_gradient_checkpointing = False
+    supports_gradient_checkpointing = True
     _no_split_modules = ["BiMambaWrapper"]
 
     def _init_weights(
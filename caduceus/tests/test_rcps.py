@@ -16,7 +16,7 @@ from caduceus.modeling_rcps import (
     RCPSEmbedding, RCPSAddNormWrapper, RCPSLMHead, RCPSWrapper
 )
 
-from caduceus.modeling_caduceus import CaduceusConfig, CaduceusMixerModel, CaduceusForMaskedLM, create_block
+from caduceus.modeling_caduceus import Caduceus, CaduceusConfig, CaduceusMixerModel, CaduceusForMaskedLM, create_block
 
 
 @pytest.mark.parametrize("batch_size", [4])
@@ -475,3 +475,75 @@ def test_collapse_invariance(batch_size, seq_len, n_layer, d_model, dtype, bidir
     assert tuple(out_collapse.size()) == (batch_size, seq_len, d_model)
     assert tuple(rc_out_collapse.size()) == (batch_size, seq_len, d_model)
     assert torch.allclose(out_collapse.detach(), rc_out_collapse.detach(), rtol=rtol, atol=atol)
+
+
+@pytest.mark.parametrize("batch_size", [2])
+@pytest.mark.parametrize("seq_len", [1024])
+@pytest.mark.parametrize("n_layer", [2])
+@pytest.mark.parametrize("d_model", [128])
+@pytest.mark.parametrize("dtype", [torch.float32])
+@pytest.mark.parametrize("fused_add_norm", [True, False])
+def test_rcps_gradient_checkpointing(batch_size, seq_len, n_layer, d_model, dtype, fused_add_norm):
+    # Set tolerance
+    device = torch.device("cuda")
+    rtol, atol = (6e-4, 2e-3) if dtype == torch.float32 else (3e-3, 5e-3)
+
+    # Set seed
+    torch.random.manual_seed(0)
+
+    # Define complement map
+    str_to_id = {"[CLS]": 0, "[MASK]": 1, "A": 2, "C": 3, "G": 4, "T": 5, "N": 6}
+    complement_map = {"A": "T", "C": "G", "G": "C", "T": "A"}
+    complement_map = {
+        str_to_id[k]: str_to_id[complement_map[k]] if k in complement_map.keys() else v
+        for k, v in str_to_id.items()
+    }
+
+    # Setup CaduceusConfig
+    initializer_cfg = {"initializer_range": 0.02, "rescale_prenorm_residual": True, "n_residuals_per_layer": 1}
+    ssm_cfg = {
+        "d_state": 16, "d_conv": 4, "expand": 2, "dt_rank": "auto", "dt_min": 0.001, "dt_max": 0.1, "dt_init": "random",
+        "dt_scale": 1.0, "dt_init_floor": 1e-4, "conv_bias": True, "bias": False, "use_fast_path": True
+    }
+    config = CaduceusConfig(
+        d_model=d_model,
+        n_layer=n_layer,
+        vocab_size=12,
+        ssm_cfg=ssm_cfg,
+        rms_norm=True,
+        residual_in_fp32=False,
+        fused_add_norm=fused_add_norm,
+        pad_vocab_size_multiple=8,
+        norm_epsilon=1e-5,
+        initializer_cfg=initializer_cfg,
+        bidirectional=True,
+        bidirectional_strategy="add",
+        bidirectional_weight_tie=True,
+        rcps=True,
+        complement_map=complement_map,
+    )
+    factory_kwargs = {"device": device, "dtype": dtype}
+
+    # Instantiate model
+    model = Caduceus(config, **factory_kwargs).to(device)
+    model.train()
+
+    # Generate random sequences
+    input_ids = torch.randint(low=1, high=len(str_to_id), size=(batch_size, seq_len), device=device)
+
+    # Test that checkpointing layers leaves outputs and gradients unchanged
+    out = model(input_ids, return_dict=False)
+    out.sum().backward()
+    grads = {name: p.grad.detach().clone() for name, p in model.named_parameters() if p.grad is not None}
+    model.zero_grad(set_to_none=True)
+
+    model.gradient_checkpointing_enable()
+    assert model.backbone.gradient_checkpointing
+    out_ckpt = model(input_ids, return_dict=False)
+    out_ckpt.sum().backward()
+    grads_ckpt = {name: p.grad.detach().clone() for name, p in model.named_parameters() if p.grad is not None}
+
+    assert torch.allclose(out.detach(), out_ckpt.detach(), rtol=rtol, atol=atol)
+    assert grads.keys() == grads_ckpt.keys()
+    for name in grads.keys():
+        assert torch.allclose(grads[name], grads_ckpt[name], rtol=rtol, atol=atol)
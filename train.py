@@ -147,19 +147,16 @@ class SequenceLightningModule(pl.LightningModule):
         # PL has some bugs, so add hooks and make sure they're only called once
         self._has_setup = False
 
-        # To be set in `setup`
+        # To be set in `setup`, which PL calls once the trainer has started (or `load_state_dict` calls when loading
+        # from a checkpoint), rather than here at construction time
         self.encoder, self.decoder, self.model = None, None, None
         self.task, self.loss, self.loss_val = None, None, None
         self.metrics, self.train_torchmetrics, self.val_torchmetrics, self.test_torchmetrics = None, None, None, None
-        self.setup()
 
         self._state = None
         self.val_loader_names, self.test_loader_names = None, None
 
     def setup(self, stage=None):
-        if not self.hparams.train.disable_dataset:
-            self.dataset.setup()
-
         # We need to set up the model in setup() because for some reason when training with DDP, one GPU uses much more
         # memory than the others.
         # In order to not overwrite the model multiple times during different stages, we need this hack
@@ -170,6 +167,11 @@ class SequenceLightningModule(pl.LightningModule):
         else:
             self._has_setup = True
 
+        # Dataset setup (download checks, preprocessing, Arrow loads) is also only needed once per process, not once
+        # per PL stage
+        if not self.hparams.train.disable_dataset:
+            self.dataset.setup()
+
         # Convenience feature: if model specifies encoder, combine it with main encoder
         encoder_cfg = utils.to_list(self.hparams.encoder) + utils.to_list(
             self.hparams.model.pop("encoder", None)
@@ -209,8 +211,9 @@ class SequenceLightningModule(pl.LightningModule):
                 if hasattr(module, name):
                     getattr(module, name)(**kwargs)
 
-        # if self.hparams.train.get("compile_model", False):
-        #     self.model = torch.compile(self.model, dynamic=False)
+        if self.hparams.train.get("compile_model", False):
+            # Compile in place (rather than wrapping with torch.compile) so state_dict keys are unchanged
+            self.model.compile(dynamic=False)
 
         # Instantiate the task
         self.task = utils.instantiate(
@@ -238,6 +241,10 @@ class SequenceLightningModule(pl.LightningModule):
         self.test_torchmetrics = self.task.test_torchmetrics
 
     def load_state_dict(self, state_dict, strict=False):
+        # `load_from_checkpoint` loads weights right after `__init__`, before PL has called `setup`
+        if not self._has_setup:
+            self.setup()
+
         if self.hparams.train.pretrained_model_state_hook['_name_'] is not None:
             model_state_hook = utils.instantiate(
                 registry.model_state_hook,
@@ -409,6 +416,8 @@ class SequenceLightningModule(pl.LightningModule):
         # Note that this currently runs into a bug in the progress bar with ddp (as of 1.4.6)
         # https://github.com/PyTorchLightning/pytorch-lightning/pull/9142
         # We additionally log the epochs under 'trainer' to get a consistent prefix with 'global_step'
+        # These are step-only logs, so `sync_dist` is left off: it would all-reduce across ranks on every step, while
+        # the epoch-level loss is already synced in `_shared_step`
         loss_epoch = {"trainer/loss": loss, "trainer/epoch": float(self.current_epoch)}
         self.log_dict(
             loss_epoch,
@@ -416,7 +425,7 @@ class SequenceLightningModule(pl.LightningModule):
             on_epoch=False,
             prog_bar=False,
             add_dataloader_idx=False,
-            sync_dist=True,
+            sync_dist=False,
         )
 
         # Log any extra info that the models want to expose (e.g. output norms)
@@ -431,7 +440,7 @@ class SequenceLightningModule(pl.LightningModule):
             on_epoch=False,
             prog_bar=False,
             add_dataloader_idx=False,
-            sync_dist=True,
+            sync_dist=False,
         )
         return loss
 
@@ -457,6 +466,10 @@ class SequenceLightningModule(pl.LightningModule):
             batch, batch_idx, prefix=self.test_loader_names[dataloader_idx]
         )
 
+    def optimizer_zero_grad(self, epoch, batch_idx, optimizer, optimizer_idx):
+        # Free gradients instead of zero-filling them, independent of the torch version's `zero_grad` default
+        optimizer.zero_grad(set_to_none=True)
+
     def configure_optimizers(self):
         # Set zero weight decay for some params
         if 'optimizer_param_grouping' in self.hparams.train:
@@ -466,6 +479,15 @@ class SequenceLightningModule(pl.LightningModule):
         all_params = list(self.parameters())
         params = [p for p in all_params if not hasattr(p, "_optim")]
 
+        # `fused: null` defers the choice to here, where parameter devices and the precision plugin are known: fused
+        # kernels need CUDA params, and since they unscale gradients inside step(), PL refuses to clip gradients with
+        # them under a GradScaler (precision=16)
+        if "fused" in self.hparams.optimizer and self.hparams.optimizer.fused is None:
+            self.hparams.optimizer.fused = all(p.is_cuda for p in all_params) and (
+                not self.trainer.gradient_clip_val
+                or getattr(self.trainer.precision_plugin, "scaler", None) is None
+            )
+
         optimizer = utils.instantiate(registry.optimizer, self.hparams.optimizer, params)
 
         del self.hparams.optimizer._name_
@@ -556,8 +578,13 @@ class SequenceLightningModule(pl.LightningModule):
 
     def _eval_dataloaders(self):
         # Return all val + test loaders
-        val_loaders = self.dataset.val_dataloader(**self.hparams.loader)
-        test_loaders = self.dataset.test_dataloader(**self.hparams.loader)
+        # Worker persistence / deeper prefetching only applies to the train loader: eval workers are torn down after
+        # each pass rather than keeping two more full-core worker pools (and their prefetched batches) alive all run
+        loader_args = {
+            k: v for k, v in self.hparams.loader.items() if k not in ("persistent_workers", "prefetch_factor")
+        }
+        val_loaders = self.dataset.val_dataloader(**loader_args)
+        test_loaders = self.dataset.test_dataloader(**loader_args)
         val_loader_names, val_loaders = self._eval_dataloaders_names(val_loaders, "val")
         test_loader_names, test_loaders = self._eval_dataloaders_names(
             test_loaders, "test"
@@ -672,8 +699,6 @@ def train(config):
         trainer.validate(model)
 
     log.info(f'{config.train.ckpt=} {fsspec_exists(config.train.ckpt)=}')
-    # if config.train.get("compile_model", False):
-    #     model = torch.compile(model, mode="reduce-overhead")
     if config.train.ckpt is not None and fsspec_exists(config.train.ckpt):
         trainer.fit(model, ckpt_path=config.train.ckpt)
     else:
@@ -704,10 +729,10 @@ def main(config: OmegaConf):
     # - filter out keys used only for interpolation
     # - optional hooks, including disabling python warnings or debug friendly configuration
     config = utils.train.process_config(config)
-    # if config.train.get("compile_model", False):
-    #     # See: https://github.com/arogozhnikov/einops/wiki/Using-torch.compile-with-einops
-    #     from einops._torch_specific import allow_ops_in_compiled_graph  # requires einops>=0.6.1
-    #     allow_ops_in_compiled_graph()
+    if config.train.get("compile_model", False):
+        # See: https://github.com/arogozhnikov/einops/wiki/Using-torch.compile-with-einops
+        from einops._torch_specific import allow_ops_in_compiled_graph  # requires einops>=0.6.1
+        allow_ops_in_compiled_graph()
 
     # Pretty print config using Rich library
     utils.train.print_config(config, resolve=True)
@@ -10,10 +10,11 @@ from typing import Dict, Iterable, Optional
 
 import enformer_pytorch
 import fsspec
+import numpy as np
 import torch
 import torch.distributed as dist
 import torch.nn as nn
-from datasets import load_dataset, load_from_disk
+from datasets import Sequence, Value, load_dataset, load_from_disk
 from sklearn import preprocessing
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data import DataLoader, DistributedSampler
@@ -113,62 +114,69 @@ def fsspec_listdir(dirname):
 
 # Processing functions
 def recast_chromosome_tissue_dist2TSS(examples):
-    """Recast chromosome to int."""
+    """Recast chromosome to int (batched)."""
     return {
-        "chromosome": -1 if examples["chromosome"] == "X" else int(examples["chromosome"]),
+        "chromosome": [-1 if chromosome == "X" else int(chromosome) for chromosome in examples["chromosome"]],
         "tissue": examples["tissue"],
         "distance_to_nearest_tss": examples["distance_to_nearest_tss"]
     }
 
 
-def tokenize_variants(examples, tokenizer, max_length: int):
+def get_char_token_lut(tokenizer) -> Optional[np.ndarray]:
+    """Build a byte -> token id lookup table for Caduceus' character-level tokenizer.
+
+    Returns None for any other tokenizer.
+    """
+    # Tokenizer is loaded from the hub with `trust_remote_code`, so compare by name rather than with `isinstance`
+    if type(tokenizer).__name__ != "CaduceusTokenizer":
+        return None
+    vocab = tokenizer.get_vocab()
+    # Mirrors `CaduceusTokenizer`: base pairs are upper-cased and characters outside the vocab map to [UNK]
+    return np.array([vocab.get(chr(b).upper(), tokenizer.unk_token_id) for b in range(256)], dtype=np.int64)
+
+
+def tokenize_variants(examples, tokenizer, max_length: int, token_lut: Optional[np.ndarray] = None):
     """Tokenize sequence.
 
     Args:
         examples: (batch of) items from the dataset.
         tokenizer: AutoTokenizer.
         max_length: int.
+        token_lut: np.ndarray, optional byte -> token id lookup table (see `get_char_token_lut`) used in place of
+            `tokenizer` when provided.
     Returns:
         dict with values as list of token ids.
     """
-
-    ref_tokenized = tokenizer.batch_encode_plus(
-        examples["ref_forward_sequence"],
-        add_special_tokens=False,
-        return_attention_mask=False,
-        max_length=max_length,
-        truncation=True,
-    )
-    alt_tokenized = tokenizer.batch_encode_plus(
-        examples["alt_forward_sequence"],
-        add_special_tokens=False,
-        return_attention_mask=False,
-        max_length=max_length,
-        truncation=True,
-    )
-    ref_rc_tokenized = tokenizer.batch_encode_plus(
-        [string_reverse_complement(seq) for seq in examples["ref_forward_sequence"]],
-        add_special_tokens=False,
-        return_attention_mask=False,
-        max_length=max_length,
-        truncation=True,
-    )
-    alt_rc_tokenized = tokenizer.batch_encode_plus(
-        [string_reverse_complement(seq) for seq in examples["alt_forward_sequence"]],
-        add_special_tokens=False,
-        return_attention_mask=False,
-        max_length=max_length,
-        truncation=True,
-    )
+    if token_lut is not None:
+        # One character per token, so truncating the string is the same as truncating the token ids
+        def encode(seqs):
+            return [
+                token_lut[np.frombuffer(seq[:max_length].encode("ascii"), dtype=np.uint8)].tolist() for seq in seqs
+            ]
+    else:
+        def encode(seqs):
+            return tokenizer.batch_encode_plus(
+                seqs,
+                add_special_tokens=False,
+                return_attention_mask=False,
+                max_length=max_length,
+                truncation=True,
+            )["input_ids"]
 
     return {
-        "ref_input_ids": ref_tokenized["input_ids"],
-        "alt_input_ids": alt_tokenized["input_ids"],
-        "ref_rc_input_ids": ref_rc_tokenized["input_ids"],
-        "alt_rc_input_ids": alt_rc_tokenized["input_ids"],
+        "ref_input_ids": encode(examples["ref_forward_sequence"]),
+        "alt_input_ids": encode(examples["alt_forward_sequence"]),
+        "ref_rc_input_ids": encode([string_reverse_complement(seq) for seq in examples["ref_forward_sequence"]]),
+        "alt_rc_input_ids": encode([string_reverse_complement(seq) for seq in examples["alt_forward_sequence"]]),
     }
 
 
+def get_token_id_dtype(tokenizer) -> str:
+    """Smallest (signed) integer dtype that can hold every token id of the tokenizer."""
+    vocab_size = len(tokenizer.encode_map) if isinstance(tokenizer, EnformerTokenizer) else len(tokenizer)
+    return "int8" if vocab_size <= np.iinfo(np.int8).max + 1 else "int16"
+
+
 def find_variant_idx(examples):
     """Find token location that differs between reference and variant sequence.
 
@@ -232,26 +240,41 @@ def prepare_dataset(args, tokenizer):
                 pass
 
             # Process data
+            num_proc = len(os.sched_getaffinity(0))
             dataset = dataset.filter(
-                lambda example: example["ref_forward_sequence"].count('N') < 0.005 * args.seq_len,
+                lambda examples: [seq.count('N') < 0.005 * args.seq_len for seq in examples["ref_forward_sequence"]],
+                batch_size=1000,
+                batched=True,
+                num_proc=num_proc,
                 desc="Filter N's"
             )
             dataset = dataset.map(
                 recast_chromosome_tissue_dist2TSS,
+                batch_size=1000,
+                batched=True,
+                num_proc=num_proc,
                 remove_columns=["chromosome", "tissue", "distance_to_nearest_tss"],
                 desc="Recast chromosome"
             )
             dataset = dataset.map(
-                partial(tokenize_variants, tokenizer=tokenizer, max_length=num_tokens),
+                partial(
+                    tokenize_variants, tokenizer=tokenizer, max_length=num_tokens,
+                    token_lut=get_char_token_lut(tokenizer)
+                ),
                 batch_size=1000,
                 batched=True,
                 remove_columns=["ref_forward_sequence", "alt_forward_sequence"],
                 desc="Tokenize"
             )
             dataset = dataset.map(find_variant_idx, desc="Find variant idx")
+            # Store token ids compactly; they are only cast to int64 on device, right before the forward pass
+            token_id_dtype = get_token_id_dtype(tokenizer)
+            for key in ["ref_input_ids", "alt_input_ids", "ref_rc_input_ids", "alt_rc_input_ids"]:
+                dataset = dataset.cast_column(key, Sequence(Value(token_id_dtype)))
             dataset.save_to_disk(preprocessed_cache_file)
     dist.barrier()  # Processes need to wait for dataset to be saved to disk (if not already done)
-    dataset = load_from_disk(preprocessed_cache_file)
+    # Numpy format keeps the compact token id dtype through the collator (torch format would re-cast to int64)
+    dataset = load_from_disk(preprocessed_cache_file).with_format("numpy")
     log.warning(f"Loaded preprocessed dataset from {preprocessed_cache_file}")
     log.warning(dataset)
     return dataset
@@ -272,42 +295,74 @@ def concat_storage_dict_values(storage_dict):
     return {key: torch.cat(storage_dict[key], dim=0) for key in storage_dict.keys()}
 
 
+def store_batch_values(storage_dict, key, value, offset, num_samples):
+    """Helper method that writes a batch of values into a preallocated buffer storage_dict[key] at offset.
+
+    Buffers are allocated on first use with shape (num_samples, *value.shape[1:]) and value's device / dtype.
+    """
+    if key not in storage_dict:
+        storage_dict[key] = value.new_empty((num_samples, *value.shape[1:]))
+    storage_dict[key][offset:offset + value.size(0)] = value
+
+
 def dump_embeddings(args, dataset, model, device):
     """Dump embeddings to disk."""
-    def extract_embeddings(item_ref, item_alt, variant_idx):
+    # Window is the same for every batch, so compute its offsets once
+    is_enformer = "enformer" in args.model_name_or_path.lower()
+    if is_enformer:
+        window_size = WINDOW_SIZE_BP // 128  # Enformer's receptive field is 128
+    else:
+        window_size = WINDOW_SIZE_BP // args.bp_per_token
+    # Add 1 so that window is: [window // 2 - SNP - window // 2]
+    start, end = -window_size // 2, window_size // 2 + 1
+    window_len = end - start
+    window_offsets = torch.arange(start, end, device=device)
+
+    def extract_embeddings(item_ref, item_alt, variant_idx, flip_dims=()):
         """Extract embedding representation from last layer outputs
 
         Args:
             item_ref: torch.Tensor, shape (batch_size, seq_len, hidden_size) Ref embedding
             item_alt: torch.Tensor, shape (batch_size, seq_len, hidden_size) Alt embedding
             variant_idx: torch.Tensor, shape (batch_size,) Index of variant
+            flip_dims: tuple, dims (1: length, 2: channel) along which item_ref / item_alt should be read as flipped
         Returns:
             layer_metrics: dict, with values to save to disk
         """
         layer_metrics = {}
 
         # Compute windowed statistics
-        if "enformer" in args.model_name_or_path.lower():
-            window_size = WINDOW_SIZE_BP // 128  # Enformer's receptive field is 128
+        if is_enformer:
             # We also need to override variant_idx since Enformer model reduces to target_length of 896
             variant_idx = torch.ones_like(variant_idx) * item_ref.size(1) // 2
+        window_start = int(variant_idx[0]) + start
+        if (variant_idx == variant_idx[0]).all() and 0 <= window_start <= item_ref.size(1) - window_len:
+            # Window is contiguous, in bounds, and shared across the batch: take it as a view instead of gathering
+            if 1 in flip_dims:
+                # Window of the length-flipped items is the mirrored window of the un-flipped items
+                window_start = item_ref.size(1) - (window_start + window_len)
+            # Ref and alt windows are stacked so that both are averaged in a single reduction
+            tokens_window = torch.stack(
+                [item_ref.narrow(1, window_start, window_len), item_alt.narrow(1, window_start, window_len)], dim=1
+            ).mean(dim=2)  # (batch_size, 2, hidden_size)
+            if 2 in flip_dims:
+                # Channel flip commutes with the mean, so only the pooled window needs to be flipped
+                tokens_window = tokens_window.flip(dims=[-1])
+            layer_metrics["concat_avg_ws"] = tokens_window.flatten(start_dim=1)
         else:
-            window_size = WINDOW_SIZE_BP // args.bp_per_token
-
-        # Add 1 so that window is: [window // 2 - SNP - window // 2]
-        start, end = -window_size // 2, window_size // 2 + 1
-        expanded_indices = torch.arange(start, end, device=item_ref.device).unsqueeze(0) + \
-                           variant_idx.unsqueeze(1).to(item_ref.device)
-        expanded_indices = torch.clamp(expanded_indices, 0, item_ref.size(1) - 1)  # Handle boundary conditions
-        tokens_window_ref = torch.gather(
-            item_ref, 1,
-            expanded_indices.unsqueeze(-1).expand(-1, -1, item_ref.size(2))
-        ).mean(dim=1)
-        tokens_window_alt = torch.gather(
-            item_alt, 1,
-            expanded_indices.unsqueeze(-1).expand(-1, -1, item_ref.size(2))
-        ).mean(dim=1)
-        layer_metrics["concat_avg_ws"] = torch.cat([tokens_window_ref, tokens_window_alt], dim=-1)
+            if flip_dims:
+                item_ref, item_alt = item_ref.flip(dims=flip_dims), item_alt.flip(dims=flip_dims)
+            expanded_indices = window_offsets.unsqueeze(0) + variant_idx.unsqueeze(1).to(item_ref.device)
+            expanded_indices = torch.clamp(expanded_indices, 0, item_ref.size(1) - 1)  # Handle boundary conditions
+            tokens_window_ref = torch.gather(
+                item_ref, 1,
+                expanded_indices.unsqueeze(-1).expand(-1, -1, item_ref.size(2))
+            ).mean(dim=1)
+            tokens_window_alt = torch.gather(
+                item_alt, 1,
+                expanded_indices.unsqueeze(-1).expand(-1, -1, item_ref.size(2))
+            ).mean(dim=1)
+            layer_metrics["concat_avg_ws"] = torch.cat([tokens_window_ref, tokens_window_alt], dim=-1)
         return layer_metrics
 
     embeds_path = osp.join(args.downstream_save_dir, args.name)
@@ -324,10 +379,13 @@ def dump_embeddings(args, dataset, model, device):
 
     # Process label_encoder = preprocessing.LabelEncoder()
     label_encoder = preprocessing.LabelEncoder()
-    label_encoder.fit(dataset["test"]["tissue"])
-    train_tissue_embed = label_encoder.transform(dataset["train"]["tissue"])
+    # Read each split's tissue column once, straight from Arrow into numpy rather than as python lists
+    train_tissue = dataset["train"].with_format("numpy")["tissue"]
+    test_tissue = dataset["test"].with_format("numpy")["tissue"]
+    label_encoder.fit(test_tissue)
+    train_tissue_embed = label_encoder.transform(train_tissue)
     dataset["train"] = dataset["train"].add_column("tissue_embed", train_tissue_embed)
-    test_tissue_embed = label_encoder.transform(dataset["test"]["tissue"])
+    test_tissue_embed = label_encoder.transform(test_tissue)
     dataset["test"] = dataset["test"].add_column("tissue_embed", test_tissue_embed)
 
     if not all([
@@ -342,14 +400,9 @@ def dump_embeddings(args, dataset, model, device):
 
             dl = DataLoader(split, **dataloader_params, sampler=sampler)
 
-            storage_dict = {
-                "concat_avg_ws": [],
-                "rc_concat_avg_ws": [],
-                "chromosome": [],
-                "labels": [],
-                "distance_to_nearest_tss": [],
-                "tissue_embed": [],
-            }
+            # Every rank sees exactly len(dl) full batches (drop_last), so buffers can be preallocated
+            num_samples = len(dl) * dataloader_params["batch_size"]
+            storage_dict = {}
 
             with torch.no_grad():
 
@@ -357,46 +410,51 @@ def dump_embeddings(args, dataset, model, device):
                         enumerate(dl), total=len(dl), desc=f"[RANK {dist.get_rank()}] Embedding {split_name}",
                         disable=dist.get_rank() != 0  # Only rank 0 updates pbar
                 ):
+                    offset = batch_idx * dataloader_params["batch_size"]
                     for key in ["chromosome", "labels", "distance_to_nearest_tss", "tissue_embed"]:
-                        storage_dict[key].append(batch[key].to("cpu", non_blocking=True))
+                        store_batch_values(storage_dict, key, batch[key], offset, num_samples)
                     with torch.autocast(device_type="cuda", dtype=torch.float16):
-                        output_alt = model(batch["alt_input_ids"].to(device))
-                        output_ref = model(batch["ref_input_ids"].to(device))
+                        output_alt = model(batch["alt_input_ids"].to(device).long())
+                        output_ref = model(batch["ref_input_ids"].to(device).long())
                         if args.rcps:
                             num_channels = output_alt.size(-1)
-                            # Flip along length and channel dims to preserve RC equivariance
+                            # Read RC half as flipped along length and channel dims to preserve RC equivariance
                             # i.e. output_rc(RC(inputs)) = outputs(inputs)
-                            output_alt_rc = output_alt[..., num_channels // 2:].contiguous().flip(dims=[1, 2])
-                            output_ref_rc = output_ref[..., num_channels // 2:].contiguous().flip(dims=[1, 2])
+                            output_alt_rc = output_alt[..., num_channels // 2:]
+                            output_ref_rc = output_ref[..., num_channels // 2:]
                             output_alt = output_alt[..., :num_channels // 2]
                             output_ref = output_ref[..., :num_channels // 2]
+                            rc_flip_dims = (1, 2)
 
                         else:
-                            # Flip along length dim so variant_idx aligns
-                            output_alt_rc = model(batch["alt_rc_input_ids"].to(device)).contiguous().flip(dims=[1])
-                            output_ref_rc = model(batch["ref_rc_input_ids"].to(device)).contiguous().flip(dims=[1])
+                            # Read as flipped along length dim so variant_idx aligns
+                            output_alt_rc = model(batch["alt_rc_input_ids"].to(device).long())
+                            output_ref_rc = model(batch["ref_rc_input_ids"].to(device).long())
+                            rc_flip_dims = (1,)
 
                     metrics = extract_embeddings(
                         item_ref=output_ref,
                         item_alt=output_alt,
                         variant_idx=batch["variant_idx"],
                     )
+                    # Embeddings stay on device until the split is done, avoiding a device-host sync every step
                     for key, value in metrics.items():
-                        storage_dict[key].append(metrics[key].to("cpu", non_blocking=True))
+                        store_batch_values(storage_dict, key, value, offset, num_samples)
 
                     metrics_rc = extract_embeddings(
                         item_ref=output_ref_rc,
                         item_alt=output_alt_rc,
                         variant_idx=batch["variant_idx"],
+                        flip_dims=rc_flip_dims,
                     )
                     for key, value in metrics_rc.items():
-                        storage_dict[f"rc_{key}"].append(metrics_rc[key].to("cpu", non_blocking=True))
+                        store_batch_values(storage_dict, f"rc_{key}", value, offset, num_samples)
 
                     if batch_idx % 100 == 0:
                         # Every machine should print progress updates
                         print(f"[RANK {dist.get_rank()}] Completed index: {batch_idx}/{len(dl)}")
 
-                storage_dict_temp = concat_storage_dict_values(storage_dict)
+                storage_dict_temp = {key: value.cpu() for key, value in storage_dict.items()}
                 with fsspec.open(osp.join(embeds_path, f"{split_name}_embeds_{dist.get_rank()}.pt"), "wb") as f:
                     torch.save(storage_dict_temp, f)
                 print(f"[RANK {dist.get_rank()}] Saved {split_name} to {osp.join(embeds_path, f'{split_name}_embeds_{dist.get_rank()}.pt')}")
@@ -435,6 +493,9 @@ def main(args):
     # Reproducibility
     torch.use_deterministic_algorithms(True)
     torch.backends.cudnn.benchmark = False
+    # Turn on TensorFloat32 for the matmuls / convs that autocast leaves in fp32
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
 
     # Init distributed
     log.warning("Initializing distributed...")